@@ -143,27 +143,54 @@ class CompoundId(object):
             for field in parentCompoundId.fields:
                 setattr(self, field, getattr(parentCompoundId, field))
                 index += 1
-        if (self.differentiator is not None and
-                self.differentiatorFieldName in self.fields[index:]):
+        encodedLocalIds = self._encodeLocalIds(index, localIds)
+        for field, encodedLocalId in zip(self.fields[index:], encodedLocalIds):
+            setattr(self, field, encodedLocalId)
+        for idFieldName, prefix in self.containerIds:
+            values = [getattr(self, f) for f in self.fields[:prefix + 1]]
+            containerId = self.join(values)
+            obfuscated = self.obfuscate(containerId)
+            setattr(self, idFieldName, obfuscated)
+
+    @classmethod
+    def _encodeLocalIds(cls, index, localIds):
+        """
+        Returns the encoded values of the fields from the specified index
+        onwards for the specified local identifiers, inserting the
+        differentiator where needed.
+        """
+        if (cls.differentiator is not None and
+                cls.differentiatorFieldName in cls.fields[index:]):
             # insert a differentiator into the localIds if appropriate
             # for this class and we haven't advanced beyond it already
-            differentiatorIndex = self.fields[index:].index(
-                self.differentiatorFieldName)
+            differentiatorIndex = cls.fields[index:].index(
+                cls.differentiatorFieldName)
             localIds = localIds[:differentiatorIndex] + tuple([
-                self.differentiator]) + localIds[differentiatorIndex:]
-        for field, localId in zip(self.fields[index:], localIds):
+                cls.differentiator]) + localIds[differentiatorIndex:]
+        encodedLocalIds = []
+        for field, localId in zip(cls.fields[index:], localIds):
             if not isinstance(localId, basestring):
                 raise exceptions.BadIdentifierNotStringException(localId)
-            encodedLocalId = self.encode(localId)
-            setattr(self, field, encodedLocalId)
-        if len(localIds) != len(self.fields) - index:
+            encodedLocalIds.append(cls.encode(localId))
+        if len(localIds) != len(cls.fields) - index:
             raise ValueError(
                 "Incorrect number of fields provided to instantiate ID")
-        for idFieldName, prefix in self.containerIds:
-            values = [getattr(self, f) for f in self.fields[:prefix + 1]]
-            containerId = self.join(values)
-            obfuscated = self.obfuscate(containerId)
-            setattr(self, idFieldName, obfuscated)
+        return encodedLocalIds
+
+    @classmethod
+    def getIdString(cls, parentCompoundId, *localIds):
+        """
+        Returns str(cls(parentCompoundId, *localIds)) without allocating
+        the compound ID, and so without building its container IDs. This
+        is for objects such as variant annotations where we need the ID
+        string for every record.
+        """
+        values = []
+        if parentCompoundId is not None:
+            values = [getattr(parentCompoundId, field)
+                      for field in parentCompoundId.fields]
+        values.extend(cls._encodeLocalIds(len(values), localIds))
+        return cls.obfuscate(cls.join(values))
 
     def __str__(self):
         values = [getattr(self, f) for f in self.fields]
@@ -431,13 +458,15 @@ class DatamodelObject(object):
         if parentContainer is not None:
             parentId = parentContainer.getCompoundId()
         self._compoundId = self.compoundIdClass(parentId, localId)
+        # The compound ID never changes, so we format it only once.
+        self._id = str(self._compoundId)
 
     def getId(self):
         """
         Returns the string identifying this DatamodelObject within the
         server.
         """
-        return str(self._compoundId)
+        return self._id
 
     def getCompoundId(self):
         """
@@ -9,12 +9,16 @@ from __future__ import unicode_literals
 import datetime
 import glob
 import hashlib
+import itertools
 import json
+import operator
 import os
 import random
 import re
+import threading
 
 import pysam
+import xxhash
 
 import ga4gh.protocol as protocol
 import ga4gh.exceptions as exceptions
@@ -24,6 +28,59 @@ ANNOTATIONS_VEP_V82 = "VEP_v82"
 ANNOTATIONS_VEP_V77 = "VEP_v77"
 ANNOTATIONS_SNPEFF = "SNPEff"
 
+# Patterns for the parts of HGVS coding and protein annotations that we
+# use to populate AlleleLocations, e.g. "NM_001005484.1:c.431T>A" and
+# "NM_001005484.1:p.Ile144Asn".
+_hgvsCRegex = re.compile(r"c\.(\d+)(\D+)>(\D+)")
+_hgvsPRegex = re.compile(r"p\.(\D+)(\d+)(\D+)", flags=re.UNICODE)
+
+# The fields of a CSQ annotation that we use, and the layout that VEP
+# writes by default, used when the header does not describe the fields.
+_csqFields = (
+    "Allele", "Feature", "Consequence", "cDNA_position", "Protein_position")
+_csqDefaultFormat = (
+    "Allele|Gene|Feature|Feature_type|Consequence|cDNA_position|"
+    "CDS_position|Protein_position|Amino_acids|Codons|Existing_variation|"
+    "DISTANCE|STRAND|SIFT|PolyPhen|MOTIF_NAME|MOTIF_POS|HIGH_INF_POS|"
+    "MOTIF_SCORE_CHANGE")
+
+# The fields of VEP and SnpEff ANN annotations that we use: the allele,
+# consequences, feature ID, HGVS coding and protein annotations, cDNA
+# position and protein position. The full layouts are
+# VEP: Allele|Consequence|IMPACT|SYMBOL|Gene|Feature_type|Feature|BIOTYPE|
+#   EXON|INTRON|HGVSc|HGVSp|cDNA_position|CDS_position|Protein_position|
+#   Amino_acids|Codons|Existing_variation|DISTANCE|STRAND|SYMBOL_SOURCE|
+#   HGNC_ID|HGVS_OFFSET
+# SnpEff: Allele|Annotation|Annotation_Impact|Gene_Name|Gene_ID|
+#   Feature_Type|Feature_ID|Transcript_BioType|Rank|HGVS.c|HGVS.p|
+#   cDNA.pos / cDNA.length|CDS.pos / CDS.length|AA.pos / AA.length|
+#   Distance|ERRORS / WARNINGS / INFO
+# SnpEff and VEP don't agree on this :)
+_vepFieldGetter = operator.itemgetter(0, 1, 6, 10, 11, 12, 14)
+_snpEffFieldGetter = operator.itemgetter(0, 1, 6, 9, 10, 11, 13)
+
+
+def _getCsqFieldGetter(description, dataUrl):
+    """
+    Returns a function that picks the allele, feature ID, consequences,
+    cDNA position and protein position, in that order, from the split
+    fields of a CSQ annotation. The positions are taken from the
+    "Format: ..." list in the specified CSQ header description, falling
+    back to the default VEP layout if the description has no such list.
+
+    :raises: ValueError if the list lacks one of the fields we use.
+    """
+    if description is not None and "Format: " in description:
+        names = description.split("Format: ", 1)[1].strip().split("|")
+    else:
+        names = _csqDefaultFormat.split("|")
+    for field in _csqFields:
+        if field not in names:
+            raise ValueError(
+                "Unsupported annotations in '{}': CSQ format has no "
+                "'{}' field".format(dataUrl, field))
+    return operator.itemgetter(*[names.index(field) for field in _csqFields])
+
 
 def isUnspecified(str):
     """
@@ -33,6 +90,43 @@ def isUnspecified(str):
     return str == "" or str is None
 
 
+def _encodeHashInput(value):
+    """
+    Returns the specified string as UTF-8 encoded bytes, suitable for
+    feeding directly into a hash function. None is encoded as an empty
+    string.
+    """
+    if value is None:
+        return b''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+_variantHashCache = {}
+_maxVariantHashCacheSize = 65536
+
+
+def _hashVariantBases(referenceBases, alternateBases):
+    """
+    Returns the hash of the specified reference bases and tuple of
+    alternate bases. Results are memoized, as the same alleles are
+    hashed repeatedly when clients issue repeated queries.
+    """
+    key = referenceBases, alternateBases
+    if key in _variantHashCache:
+        return _variantHashCache[key]
+    # The one-shot hexdigest function avoids allocating a hasher object,
+    # and a single join avoids the intermediate concatenated strings.
+    digest = xxhash.xxh128_hexdigest(b'|'.join((
+        _encodeHashInput(referenceBases),
+        b','.join(map(_encodeHashInput, alternateBases)))))
+    if len(_variantHashCache) >= _maxVariantHashCacheSize:
+        _variantHashCache.clear()
+    _variantHashCache[key] = digest
+    return digest
+
+
 class CallSet(datamodel.DatamodelObject):
     """
     Class representing a CallSet. A CallSet basically represents the
@@ -156,7 +250,7 @@ class AbstractVariantSet(datamodel.DatamodelObject):
         self._callSetIdMap[callSetId] = callSet
         self._callSetNameMap[callSet.getLocalId()] = callSet
         self._callSetIds.append(callSetId)
-        self._callSetIdToIndex[callSet.getId()] = len(self._callSetIds) - 1
+        self._callSetIdToIndex[callSetId] = len(self._callSetIds) - 1
 
     def addCallSetFromName(self, sampleName):
         """
@@ -253,12 +347,22 @@ class AbstractVariantSet(datamodel.DatamodelObject):
     @classmethod
     def hashVariant(cls, gaVariant):
         """
-        Produces an MD5 hash of the ga variant object to distinguish
-        it from other variants at the same genomic coordinate.
+        Produces a hash of the ga variant object to distinguish it from
+        other variants at the same genomic coordinate. This is not used
+        for any security purpose, so we use the fast non-cryptographic
+        xxh128 hash, which has the same hex digest width as MD5.
         """
-        return hashlib.md5(
-            gaVariant.referenceBases +
-            str(tuple(gaVariant.alternateBases))).hexdigest()
+        return _hashVariantBases(
+            gaVariant.referenceBases, tuple(gaVariant.alternateBases))
+
+
+# Lookup tables for the simulated variant generator, so that we don't
+# rebuild the candidate lists for every variant and call.
+_simulatedBases = ("A", "C", "G", "T")
+_simulatedAlternateBases = dict(
+    (ref, tuple(base for base in _simulatedBases if base != ref))
+    for ref in _simulatedBases)
+_simulatedGenotypes = ((0, 1), (1, 0), (1, 1))
 
 
 class SimulatedVariantSet(AbstractVariantSet):
@@ -300,13 +404,17 @@ class SimulatedVariantSet(AbstractVariantSet):
                     callSetIds=None):
         randomNumberGenerator = random.Random()
         randomNumberGenerator.seed(self._randomSeed)
-        i = startPosition
-        while i < endPosition:
-            if randomNumberGenerator.random() < self._variantDensity:
+        # The density check for each position draws from a stream that is
+        # reseeded on every hit, so positions must be visited in order.
+        # When every position is a hit the draw is always discarded by the
+        # reseed, so we can skip it without changing the output.
+        alwaysHit = self._variantDensity >= 1
+        nextRandom = randomNumberGenerator.random
+        for i in xrange(startPosition, endPosition):
+            if alwaysHit or nextRandom() < self._variantDensity:
                 randomNumberGenerator.seed(self._randomSeed + i)
                 yield self.generateVariant(
                     referenceName, i, randomNumberGenerator)
-            i += 1
 
     def generateVariant(self, referenceName, position, randomNumberGenerator):
         """
@@ -320,33 +428,31 @@ class SimulatedVariantSet(AbstractVariantSet):
         variant.referenceName = referenceName
         variant.start = position
         variant.end = position + 1  # SNPs only for now
-        bases = ["A", "C", "G", "T"]
-        ref = randomNumberGenerator.choice(bases)
+        choice = randomNumberGenerator.choice
+        ref = choice(_simulatedBases)
         variant.referenceBases = ref
-        alt = randomNumberGenerator.choice(
-            [base for base in bases if base != ref])
+        alt = choice(_simulatedAlternateBases[ref])
         variant.alternateBases = [alt]
         variant.calls = []
         for callSet in self.getCallSets():
-            call = protocol.Call()
-            call.callSetId = callSet.getId()
             # for now, the genotype is either [0,1], [1,1] or [1,0] with equal
             # probability; probably will want to do something more
             # sophisticated later.
-            randomChoice = randomNumberGenerator.choice(
-                [[0, 1], [1, 0], [1, 1]])
-            call.genotype = randomChoice
+            randomChoice = list(choice(_simulatedGenotypes))
             # TODO What is a reasonable model for generating these likelihoods?
             # Are these log-scaled? Spec does not say.
-            call.genotypeLikelihood = [-100, -100, -100]
+            call = protocol.Call(
+                callSetId=callSet.getId(),
+                genotype=randomChoice,
+                genotypeLikelihood=[-100, -100, -100])
             variant.calls.append(call)
         variant.id = self.getVariantId(variant)
         return variant
 
 
 def _encodeValue(value):
-    if isinstance(value, (list, tuple)):
-        return [str(v) for v in value]
+    if type(value) in (list, tuple):
+        return map(str, value)
     else:
         return [str(value)]
 
@@ -359,6 +465,42 @@ def isEmptyIter(it):
     return next(it, _nothing) is _nothing
 
 
+def _getSnpEffAnnotationType(record, dataUrl):
+    """
+    Returns the annotation type for the specified SnpEffVersion header
+    record.
+    """
+    return ANNOTATIONS_SNPEFF
+
+
+def _getVepAnnotationType(record, dataUrl):
+    """
+    Returns the annotation type for the specified VEP header record, or
+    raises a ValueError if the VEP version is not supported.
+    """
+    version = record.value.split()[0]
+    # TODO we need _much_ more sophisticated processing
+    # of VEP versions here. When do they become
+    # incompatible?
+    if version == "v82":
+        return ANNOTATIONS_VEP_V82
+    elif version == "v77":
+        return ANNOTATIONS_VEP_V77
+    else:
+        # TODO raise a proper typed exception there with
+        # the file name as an argument.
+        raise ValueError(
+            "Unsupported VEP version {} in '{}'".format(version, dataUrl))
+
+
+# Maps the keys of GENERIC VCF header records to the functions that
+# determine the annotation type from those records.
+_annotationTypeDetectors = {
+    "SnpEffVersion": _getSnpEffAnnotationType,
+    "VEP": _getVepAnnotationType,
+}
+
+
 class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
     """
     Class representing a single variant set backed by a directory of indexed
@@ -368,6 +510,8 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         super(HtslibVariantSet, self).__init__(parentContainer, localId)
         self._chromFileMap = {}
         self._metadata = None
+        self._metadataIdMap = {}
+        self._sanitizedReferenceNameMap = {}
 
     def isAnnotated(self):
         """
@@ -394,15 +538,15 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         """
         self._created = row[b'created']
         self._updated = row[b'updated']
-        self._chromFileMap = {}
         # We can't load directly as we want tuples to be stored
         # rather than lists.
-        for key, value in json.loads(row[b'dataUrlIndexMap']).items():
-            self._chromFileMap[key] = tuple(value)
-        self._metadata = []
-        for jsonDict in json.loads(row[b'metadata']):
-            metadata = protocol.VariantSetMetadata.fromJsonDict(jsonDict)
-            self._metadata.append(metadata)
+        self._chromFileMap = {
+            key: (dataUrl, indexFile) for key, (dataUrl, indexFile) in
+            json.loads(row[b'dataUrlIndexMap']).iteritems()}
+        fromJsonDict = protocol.VariantSetMetadata.fromJsonDict
+        self._metadata = [
+            fromJsonDict(jsonDict)
+            for jsonDict in json.loads(row[b'metadata'])]
 
     def populateFromFile(self, dataUrls, indexFiles):
         """
@@ -443,7 +587,10 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         """
         Perform consistency check on the variant set
         """
-        for referenceName, (dataUrl, indexFile) in self._chromFileMap.items():
+        # Several references usually map to the same file, and the checks
+        # only depend on the file header, so each file is opened and
+        # checked once, as soon as we find that it contains any records.
+        for dataUrl, indexFile in self.getDataUrlIndexPairs():
             varFile = pysam.VariantFile(dataUrl, index_filename=indexFile)
             try:
                 for chrom in varFile.index:
@@ -451,6 +598,7 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
                     if not isEmptyIter(varFile.fetch(chrom)):
                         self._checkMetadata(varFile)
                         self._checkCallSetIds(varFile)
+                        break
             finally:
                 varFile.close()
 
@@ -465,10 +613,11 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
             # Unlike Tabix indices, CSI indices include all contigs defined
             # in the BCF header.  Thus we must test each one to see if
             # records exist or else they are likely to trigger spurious
-            # overlapping errors.
+            # overlapping errors. Only contigs we have already seen can
+            # overlap, so we avoid probing the others.
             chrom, _, _ = self.sanitizeVariantFileFetch(chrom)
-            if not isEmptyIter(varFile.fetch(chrom)):
-                if chrom in self._chromFileMap:
+            if chrom in self._chromFileMap:
+                if not isEmptyIter(varFile.fetch(chrom)):
                     raise exceptions.OverlappingVcfException(dataUrl, chrom)
             self._chromFileMap[chrom] = dataUrl, indexFile
         self._updateMetadata(varFile)
@@ -485,23 +634,10 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
             annotationType = None
             for record in variantFile.header.records:
                 if record.type == "GENERIC":
-                    if record.key == "SnpEffVersion":
-                        annotationType = ANNOTATIONS_SNPEFF
-                    elif record.key == "VEP":
-                        version = record.value.split()[0]
-                        # TODO we need _much_ more sophisticated processing
-                        # of VEP versions here. When do they become
-                        # incompatible?
-                        if version == "v82":
-                            annotationType = ANNOTATIONS_VEP_V82
-                        elif version == "v77":
-                            annotationType = ANNOTATIONS_VEP_V77
-                        else:
-                            # TODO raise a proper typed exception there with
-                            # the file name as an argument.
-                            raise ValueError(
-                                "Unsupported VEP version {} in '{}'".format(
-                                    version, dataUrl))
+                    detector = _annotationTypeDetectors.get(record.key)
+                    if detector is not None:
+                        annotationType = detector(record, dataUrl)
+                        break
             if annotationType is None:
                 infoKeys = variantFile.header.info.keys()
                 if 'CSQ' in infoKeys or 'ANN' in infoKeys:
@@ -537,11 +673,15 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         """
         Checks callSetIds for consistency
         """
+        # CallSet IDs are derived from the sample names, so we can compare
+        # the names directly rather than building an ID for each sample.
+        # Files with samples removed are the common failure, and can be
+        # detected from the counts alone. Fewer samples than call sets can
+        # never match, but more can if the header repeats a sample name.
         if len(self._callSetIdMap) > 0:
-            callSetIds = set([
-                self.getCallSetId(sample)
-                for sample in variantFile.header.samples])
-            if callSetIds != set(self._callSetIdMap.keys()):
+            samples = variantFile.header.samples
+            if (len(samples) < len(self._callSetNameMap) or
+                    self._callSetNameMap.viewkeys() != set(samples)):
                 raise exceptions.InconsistentCallSetIdException(
                     variantFile.filename)
 
@@ -564,17 +704,25 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         dataUrl, indexFile = dataUrlIndexFilePair
         return pysam.VariantFile(dataUrl, index_filename=indexFile)
 
-    def _convertGaCall(self, callSet, pysamCall):
+    def _convertGaCall(
+            self, callSet, pysamCall, hasGenotypeLikelihood, infoKeys):
+        """
+        Converts the specified pysam call into a GA4GH Call. The FORMAT
+        keys are the same for every call in a record, so the caller
+        passes in whether GL is present and the list of keys other than
+        GT and GL that should be stored in the call info.
+        """
         phaseset = None
         if pysamCall.phased:
             phaseset = str(pysamCall.phased)
         genotypeLikelihood = []
-        info = {}
-        for key, value in pysamCall.iteritems():
-            if key == 'GL' and value is not None:
+        if hasGenotypeLikelihood:
+            value = pysamCall[b'GL']
+            if value is not None:
                 genotypeLikelihood = list(value)
-            elif key != 'GT':
-                info[key] = _encodeValue(value)
+        info = {}
+        for key in infoKeys:
+            info[key] = _encodeValue(pysamCall[key])
         call = protocol.Call(
             callSetId=callSet.getId(),
             callSetName=callSet.getSampleName(),
@@ -585,16 +733,27 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
             genotypeLikelihood=genotypeLikelihood)
         return call
 
-    def convertVariant(self, record, callSetIds):
+    def _resolveCallSets(self, callSetIds):
+        """
+        Returns the list of (callSet, sampleName) tuples for the specified
+        list of callSetIds, suitable for passing to convertVariant.
+        """
+        resolved = []
+        for callSetId in callSetIds:
+            callSet = self.getCallSet(callSetId)
+            resolved.append((callSet, str(callSet.getSampleName())))
+        return resolved
+
+    def convertVariant(self, record, resolvedCallSets):
         """
         Converts the specified pysam variant record into a GA4GH Variant
-        object. Only calls for the specified list of callSetIds will
-        be included.
+        object. Only calls for the specified list of (callSet, sampleName)
+        tuples, as returned by _resolveCallSets, will be included.
         """
         variant = self._createGaVariant()
         variant.referenceName = record.contig
         if record.id is not None:
-            variant.names = record.id.split(';')
+            variant.names = record.id.split(b';')
         variant.start = record.start          # 0-based inclusive
         variant.end = record.stop             # 0-based exclusive
         variant.referenceBases = record.ref
@@ -602,37 +761,64 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
             variant.alternateBases = list(record.alts)
         # record.filter and record.qual are also available, when supported
         # by GAVariant.
+        # This is the hot path when streaming variants, so _encodeValue
+        # is inlined here.
+        info = {}
         for key, value in record.info.iteritems():
             if value is not None:
-                if isinstance(value, str):
-                    value = value.split(',')
-                variant.info[key] = _encodeValue(value)
+                valueType = type(value)
+                if valueType is str:
+                    info[key] = value.split(b',')
+                elif valueType in (list, tuple):
+                    info[key] = map(str, value)
+                else:
+                    info[key] = [str(value)]
+        variant.info = info
 
         variant.calls = []
-        for callSetId in callSetIds:
-            callSet = self.getCallSet(callSetId)
-            pysamCall = record.samples[str(callSet.getSampleName())]
-            variant.calls.append(
-                self._convertGaCall(callSet, pysamCall))
+        if len(resolvedCallSets) > 0:
+            formatKeys = record.format.keys()
+            hasGenotypeLikelihood = b'GL' in formatKeys
+            infoKeys = [
+                key for key in formatKeys if key != b'GT' and key != b'GL']
+            samples = record.samples
+            for callSet, sampleName in resolvedCallSets:
+                variant.calls.append(self._convertGaCall(
+                    callSet, samples[sampleName], hasGenotypeLikelihood,
+                    infoKeys))
         variant.id = self.getVariantId(variant)
         return variant
 
+    def _sanitizeReferenceName(self, referenceName):
+        """
+        Returns the sanitized contig name to fetch for the specified
+        reference name. Callers only pass names that are keys of
+        _chromFileMap, so the memo is bounded by the number of contigs.
+        """
+        sanitized = self._sanitizedReferenceNameMap.get(referenceName)
+        if sanitized is None:
+            sanitized, _, _ = self.sanitizeVariantFileFetch(referenceName)
+            self._sanitizedReferenceNameMap[referenceName] = sanitized
+        return sanitized
+
     def getVariant(self, compoundId):
-        if compoundId.referenceName in self._chromFileMap:
-            varFileName = self._chromFileMap[compoundId.referenceName]
-        else:
+        varFileName = self._chromFileMap.get(compoundId.referenceName)
+        if varFileName is None:
             raise exceptions.ObjectNotFoundException(compoundId)
         start = int(compoundId.start)
-        referenceName, startPosition, endPosition = \
-            self.sanitizeVariantFileFetch(
-                compoundId.referenceName, start, start + 1)
+        referenceName = self._sanitizeReferenceName(compoundId.referenceName)
+        _, startPosition, endPosition = self.sanitizeVariantFileFetch(
+            None, start, start + 1)
         cursor = self.getFileHandle(varFileName).fetch(
             referenceName, startPosition, endPosition)
         for record in cursor:
-            variant = self.convertVariant(record, self._callSetIds)
-            if (record.start == start and
-                    compoundId.md5 == self.hashVariant(variant)):
-                return variant
+            # Hash the alleles directly so that we only pay the cost of
+            # converting the record that actually matches.
+            alternateBases = tuple(record.alts or ())
+            if (record.start == start and compoundId.md5 ==
+                    _hashVariantBases(record.ref, alternateBases)):
+                return self.convertVariant(
+                    record, self._resolveCallSets(self._callSetIds))
             elif record.start > start:
                 raise exceptions.ObjectNotFoundException()
         raise exceptions.ObjectNotFoundException(compoundId)
@@ -642,15 +828,16 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         Returns an iterator over the pysam VCF records corresponding to the
         specified query.
         """
-        if referenceName in self._chromFileMap:
-            varFileName = self._chromFileMap[referenceName]
-            referenceName, startPosition, endPosition = \
-                self.sanitizeVariantFileFetch(
-                    referenceName, startPosition, endPosition)
-            cursor = self.getFileHandle(varFileName).fetch(
-                referenceName, startPosition, endPosition)
-            for record in cursor:
-                yield record
+        varFileName = self._chromFileMap.get(referenceName)
+        if varFileName is None:
+            return iter(())
+        referenceName = self._sanitizeReferenceName(referenceName)
+        _, startPosition, endPosition = self.sanitizeVariantFileFetch(
+            None, startPosition, endPosition)
+        # Return the pysam cursor directly rather than re-yielding each
+        # record through a Python generator frame.
+        return self.getFileHandle(varFileName).fetch(
+            referenceName, startPosition, endPosition)
 
     def getVariants(self, referenceName, startPosition, endPosition,
                     callSetIds=None):
@@ -662,12 +849,15 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
             callSetIds = self._callSetIds
         else:
             for callSetId in callSetIds:
-                if callSetId not in self._callSetIds:
+                if callSetId not in self._callSetIdMap:
                     raise exceptions.CallSetNotInVariantSetException(
                         callSetId, self.getId())
+        # Resolve the call sets once rather than for every record.
+        resolvedCallSets = self._resolveCallSets(callSetIds)
+        convertVariant = self.convertVariant
         for record in self.getPysamVariants(
                 referenceName, startPosition, endPosition):
-            yield self.convertVariant(record, callSetIds)
+            yield convertVariant(record, resolvedCallSets)
 
     def getMetadata(self):
         return self._metadata
@@ -679,6 +869,24 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         return str(datamodel.VariantSetMetadataCompoundId(
             self.getCompoundId(), 'metadata:' + metadata.key))
 
+    def _buildMetadata(
+            self, key, type_="String", number="1", value="",
+            description=""):  # All input are strings
+        """
+        Returns a VariantSetMetadata object with the specified values. The
+        id depends only on the key, so ids are memoized across the files
+        of this variant set.
+        """
+        metadata = protocol.VariantSetMetadata(
+            key=key, value=value, type=type_, number=number,
+            description=description)
+        id_ = self._metadataIdMap.get(key)
+        if id_ is None:
+            id_ = self.getMetadataId(metadata)
+            self._metadataIdMap[key] = id_
+        metadata.id = id_
+        return metadata
+
     def _getMetadataFromVcf(self, varFile):
         # All the metadata is available via each varFile.header, including:
         #    records: header records
@@ -688,24 +896,9 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         #    filters -- not immediately needed
         #    info
         #    formats
-
-        def buildMetadata(
-                key, type_="String", number="1", value="", id_="",
-                description=""):  # All input are strings
-            metadata = protocol.VariantSetMetadata()
-            metadata.key = key
-            metadata.value = value
-            metadata.type = type_
-            metadata.number = number
-            metadata.description = description
-            if id_ == '':
-                id_ = self.getMetadataId(metadata)
-            metadata.id = id_
-            return metadata
-
         ret = []
         header = varFile.header
-        ret.append(buildMetadata(key="version", value=header.version))
+        ret.append(self._buildMetadata(key="version", value=header.version))
         formats = header.formats.items()
         infos = header.info.items()
         # TODO: currently ALT field is not implemented through pysam
@@ -717,7 +910,7 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
                 description = value.description.strip('"')
                 key = "{0}.{1}".format(prefix, value.name)
                 if key != "FORMAT.GT":
-                    ret.append(buildMetadata(
+                    ret.append(self._buildMetadata(
                         key=key, type_=value.type,
                         number="{}".format(value.number),
                         description=description))
@@ -741,11 +934,13 @@ class AbstractVariantAnnotationSet(datamodel.DatamodelObject):
         super(AbstractVariantAnnotationSet, self).__init__(variantSet, localId)
         self._variantSet = variantSet
         self._sequenceOntologyTermMap = None
+        self._sequenceOntologyTermIds = {}
         self._analysis = None
         # TODO these should be set from the DB, not created on
         # instantiation.
-        self._creationTime = datetime.datetime.now().isoformat() + "Z"
-        self._updatedTime = datetime.datetime.now().isoformat() + "Z"
+        now = datetime.datetime.now().isoformat() + "Z"
+        self._creationTime = now
+        self._updatedTime = now
 
     def setSequenceOntologyTermMap(self, sequenceOntologyTermMap):
         """
@@ -754,6 +949,7 @@ class AbstractVariantAnnotationSet(datamodel.DatamodelObject):
         specified value.
         """
         self._sequenceOntologyTermMap = sequenceOntologyTermMap
+        self._sequenceOntologyTermIds = {}
 
     def getAnalysis(self):
         """
@@ -819,24 +1015,42 @@ class AbstractVariantAnnotationSet(datamodel.DatamodelObject):
         return protocolElement
 
     def getTranscriptEffectId(self, gaTranscriptEffect):
-        effs = [eff.term for eff in gaTranscriptEffect.effects]
-        return hashlib.md5(
-            "{}\t{}\t{}\t{}".format(
-                gaTranscriptEffect.alternateBases,
-                gaTranscriptEffect.featureId,
-                effs, gaTranscriptEffect.hgvsAnnotation)
-            ).hexdigest()
+        """
+        Produces a hash of the gaTranscriptEffect object. The hash input
+        is built as a single byte string, and the SHA-1 digest is
+        truncated to the 32 hex characters of the MD5 used previously.
+        """
+        effs = b','.join([
+            _encodeHashInput(eff.term)
+            for eff in gaTranscriptEffect.effects])
+        # Use the HGVS fields themselves rather than the JSON repr of the
+        # HGVSAnnotation, whose key order is not guaranteed to be stable.
+        hgvs = gaTranscriptEffect.hgvsAnnotation
+        if hgvs is None:
+            hgvsFields = b'||'
+        else:
+            hgvsFields = b'|'.join((
+                _encodeHashInput(hgvs.genomic),
+                _encodeHashInput(hgvs.transcript),
+                _encodeHashInput(hgvs.protein)))
+        payload = b'\t'.join((
+            _encodeHashInput(gaTranscriptEffect.alternateBases),
+            _encodeHashInput(gaTranscriptEffect.featureId),
+            effs, hgvsFields))
+        return hashlib.sha1(payload).hexdigest()[:32]
 
     def hashVariantAnnotation(cls, gaVariant, gaVariantAnnotation):
         """
-        Produces an MD5 hash of the gaVariant and gaVariantAnnotation objects
+        Produces a hash of the gaVariant and gaVariantAnnotation objects
         """
-        treffs = [treff.id for treff in gaVariantAnnotation.transcriptEffects]
-        return hashlib.md5(
-            "{}\t{}\t{}\t".format(
-                gaVariant.referenceBases, tuple(gaVariant.alternateBases),
-                treffs)
-            ).hexdigest()
+        treffs = b','.join([
+            _encodeHashInput(treff.id)
+            for treff in gaVariantAnnotation.transcriptEffects])
+        payload = b'\t'.join((
+            _encodeHashInput(gaVariant.referenceBases),
+            b','.join(map(_encodeHashInput, gaVariant.alternateBases)),
+            treffs))
+        return hashlib.sha1(payload).hexdigest()[:32]
 
     def getVariantAnnotationId(self, gaVariant, gaAnnotation):
         """
@@ -847,10 +1061,9 @@ class AbstractVariantAnnotationSet(datamodel.DatamodelObject):
         :return:  compoundId String
         """
         md5 = self.hashVariantAnnotation(gaVariant, gaAnnotation)
-        compoundId = datamodel.VariantAnnotationCompoundId(
+        return datamodel.VariantAnnotationCompoundId.getIdString(
             self.getCompoundId(), gaVariant.referenceName,
             str(gaVariant.start), md5)
-        return str(compoundId)
 
 
 class SimulatedVariantAnnotationSet(AbstractVariantAnnotationSet):
@@ -863,6 +1076,10 @@ class SimulatedVariantAnnotationSet(AbstractVariantAnnotationSet):
             variantSet, localId)
         self._randomSeed = randomSeed
         self._analysis = self._createAnalysis()
+        # Annotations are generated by reseeding a generator per variant;
+        # keep one generator per thread rather than constructing a new
+        # one for every variant.
+        self._threadLocal = threading.local()
 
     def _createAnalysis(self):
         analysis = protocol.Analysis()
@@ -894,7 +1111,10 @@ class SimulatedVariantAnnotationSet(AbstractVariantAnnotationSet):
         # To make this reproducible, make a seed based on this
         # specific variant.
         seed = self._randomSeed + variant.start + variant.end
-        randomNumberGenerator = random.Random()
+        randomNumberGenerator = getattr(self._threadLocal, "rng", None)
+        if randomNumberGenerator is None:
+            randomNumberGenerator = random.Random()
+            self._threadLocal.rng = randomNumberGenerator
         randomNumberGenerator.seed(seed)
         ann = protocol.VariantAnnotation()
         ann.variantAnnotationSetId = str(self.getCompoundId())
@@ -904,11 +1124,11 @@ class SimulatedVariantAnnotationSet(AbstractVariantAnnotationSet):
         ann.createDateTime = self._creationTime
         # make a transcript effect for each alternate base element
         # multiplied by a random integer (0,5)
-        ann.transcriptEffects = []
-        for base in variant.alternateBases * (
-                randomNumberGenerator.randint(0, 5)):
-            ann.transcriptEffects.append(self.generateTranscriptEffect(
-                ann, base, randomNumberGenerator))
+        repeats = randomNumberGenerator.randint(0, 5)
+        generateTranscriptEffect = self.generateTranscriptEffect
+        ann.transcriptEffects = [
+            generateTranscriptEffect(ann, base, randomNumberGenerator)
+            for _ in xrange(repeats) for base in variant.alternateBases]
         ann.id = self.getVariantAnnotationId(variant, ann)
         return ann
 
@@ -986,10 +1206,24 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
     def __init__(self, variantSet, localId):
         super(HtslibVariantAnnotationSet, self).__init__(variantSet, localId)
         self._annotationCreatedDateTime = self._creationTime
+        self._csqFieldGetter = _getCsqFieldGetter(None, None)
+
+    def _updateCsqFieldGetter(self, dataUrl):
+        """
+        Locates the fields used from CSQ annotations using the CSQ header
+        description recorded in the analysis. Only the annotation types
+        converted by convertTranscriptEffectCSQ use this.
+        """
+        if self._annotationType in (ANNOTATIONS_SNPEFF, ANNOTATIONS_VEP_V82):
+            return
+        descriptions = self._analysis.info.get("INFO.CSQ")
+        self._csqFieldGetter = _getCsqFieldGetter(
+            descriptions[0] if descriptions else None, dataUrl)
 
     def populateFromFile(self, varFile, annotationType):
         self._annotationType = annotationType
         self._analysis = self._getAnnotationAnalysis(varFile)
+        self._updateCsqFieldGetter(varFile.filename)
         # TODO parse the annotation creation time from the VCF header and
         # store it in an instance variable.
 
@@ -1000,6 +1234,7 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         self._annotationType = row[b'annotationType']
         self._analysis = protocol.Analysis.fromJsonDict(
             json.loads(row[b'analysis']))
+        self._updateCsqFieldGetter(self.getLocalId())
 
     def getAnnotationType(self):
         """
@@ -1016,23 +1251,22 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         """
         header = varFile.header
         analysis = protocol.Analysis()
-        formats = header.formats.items()
-        infos = header.info.items()
-        for prefix, content in [("FORMAT", formats), ("INFO", infos)]:
-            for contentKey, value in content:
-                key = "{0}.{1}".format(prefix, value.name)
-                if key not in analysis.info:
-                    analysis.info[key] = []
+        info = analysis.info
+        formats = header.formats.itervalues()
+        infos = header.info.itervalues()
+        for prefix, content in (("FORMAT", formats), ("INFO", infos)):
+            for value in content:
+                # Every declared field gets a key, even without a description
+                descriptions = info.setdefault(
+                    "{0}.{1}".format(prefix, value.name), [])
                 if value.description is not None:
-                    analysis.info[key].append(value.description)
+                    descriptions.append(value.description)
         analysis.createDateTime = self._creationTime
         analysis.updateDateTime = self._updatedTime
         for r in header.records:
             # Don't add a key to info if there's nothing in the value
             if r.value is not None:
-                if r.key not in analysis.info:
-                    analysis.info[r.key] = []
-                analysis.info[r.key].append(str(r.value))
+                info.setdefault(r.key, []).append(str(r.value))
             if r.key == "created":
                 # TODO handle more date formats
                 analysis.createDateTime = datetime.datetime.strptime(
@@ -1067,8 +1301,9 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
             transcriptConverter = self.convertTranscriptEffectVEP
         else:
             transcriptConverter = self.convertTranscriptEffectCSQ
+        convertVariantAnnotation = self.convertVariantAnnotation
         for record in variantIter:
-            yield self.convertVariantAnnotation(record, transcriptConverter)
+            yield convertVariantAnnotation(record, transcriptConverter)
 
     def convertLocation(self, pos):
         """
@@ -1077,14 +1312,14 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         :param pos:
         :return: protocol.AlleleLocation
         """
-        if isUnspecified(pos):
+        if not pos:
             return None
-        coordLen = pos.split('/')
-        if len(coordLen) > 1:
-            allLoc = self._createGaAlleleLocation()
-            allLoc.start = int(coordLen[0]) - 1
-            return allLoc
-        return None
+        slash = pos.find(b'/')
+        if slash < 0:
+            return None
+        allLoc = self._createGaAlleleLocation()
+        allLoc.start = int(pos[:slash]) - 1
+        return allLoc
 
     def convertLocationHgvsC(self, hgvsc):
         """
@@ -1093,9 +1328,9 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         :param hgvsc:
         :return:
         """
-        if isUnspecified(hgvsc):
+        if not hgvsc or b'c.' not in hgvsc:
             return None
-        match = re.match(".*c.(\d+)(\D+)>(\D+)", hgvsc)
+        match = _hgvsCRegex.search(hgvsc)
         if match:
             pos = int(match.group(1))
             if pos > 0:
@@ -1113,9 +1348,9 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         :param hgvsp:
         :return: protocol.AlleleLocation
         """
-        if isUnspecified(hgvsp):
+        if not hgvsp or b'p.' not in hgvsp:
             return None
-        match = re.match(".*p.(\D+)(\d+)(\D+)", hgvsp, flags=re.UNICODE)
+        match = _hgvsPRegex.search(hgvsp)
         if match is not None:
             allLoc = self._createGaAlleleLocation()
             allLoc.referenceSequence = match.group(1)
@@ -1124,33 +1359,6 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
             return allLoc
         return None
 
-    def addCDSLocation(self, effect, cdnaPos):
-        hgvsC = effect.hgvsAnnotation.transcript
-        if not isUnspecified(hgvsC):
-            effect.CDSLocation = self.convertLocationHgvsC(hgvsC)
-        if effect.CDSLocation is None:
-            effect.CDSLocation = self.convertLocation(cdnaPos)
-        else:
-            # These are not stored in the VCF
-            effect.CDSLocation.alternateSequence = None
-            effect.CDSLocation.referenceSequence = None
-
-    def addProteinLocation(self, effect, protPos):
-        hgvsP = effect.hgvsAnnotation.protein
-        if not isUnspecified(hgvsP):
-            effect.proteinLocation = self.convertLocationHgvsP(hgvsP)
-        if effect.proteinLocation is None:
-            effect.proteinLocation = self.convertLocation(protPos)
-
-    def addCDNALocation(self, effect, cdnaPos):
-        hgvsC = effect.hgvsAnnotation.transcript
-        effect.cDNALocation = self.convertLocation(cdnaPos)
-        if self.convertLocationHgvsC(hgvsC):
-            effect.cDNALocation.alternateSequence = \
-                self.convertLocationHgvsC(hgvsC).alternateSequence
-            effect.cDNALocation.referenceSequence = \
-                self.convertLocationHgvsC(hgvsC).referenceSequence
-
     def addLocations(self, effect, protPos, cdnaPos):
         """
         Adds locations to a GA4GH transcript effect object
@@ -1161,9 +1369,30 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         :param cdnaPos: String representing coding DNA location
         :return: effect protocol.TranscriptEffect
         """
-        self.addCDSLocation(effect, cdnaPos)
-        self.addCDNALocation(effect, cdnaPos)
-        self.addProteinLocation(effect, protPos)
+        # Each HGVS annotation is parsed once; the parsed coding location
+        # supplies the cDNA sequences and then becomes the CDS location.
+        convertLocation = self.convertLocation
+        hgvsCLocation = self.convertLocationHgvsC(
+            effect.hgvsAnnotation.transcript)
+        cdnaLocation = convertLocation(cdnaPos)
+        if hgvsCLocation is not None:
+            if cdnaLocation is not None:
+                cdnaLocation.alternateSequence = \
+                    hgvsCLocation.alternateSequence
+                cdnaLocation.referenceSequence = \
+                    hgvsCLocation.referenceSequence
+            # These are not stored in the VCF
+            hgvsCLocation.alternateSequence = None
+            hgvsCLocation.referenceSequence = None
+            effect.CDSLocation = hgvsCLocation
+        else:
+            effect.CDSLocation = convertLocation(cdnaPos)
+        effect.cDNALocation = cdnaLocation
+        proteinLocation = self.convertLocationHgvsP(
+            effect.hgvsAnnotation.protein)
+        if proteinLocation is None:
+            proteinLocation = convertLocation(protPos)
+        effect.proteinLocation = proteinLocation
         return effect
 
     def convertTranscriptEffectCSQ(self, annStr, hgvsG):
@@ -1175,15 +1404,11 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         :param hgvsG: String
         :return: [protocol.TranscriptEffect]
         """
-        # Allele|Gene|Feature|Feature_type|Consequence|cDNA_position|
-        # CDS_position|Protein_position|Amino_acids|Codons|Existing_variation|
-        # DISTANCE|STRAND|SIFT|PolyPhen|MOTIF_NAME|MOTIF_POS|HIGH_INF_POS|MOTIF_SCORE_CHANGE
-
-        (alt, gene, featureId, featureType, effects, cdnaPos,
-         cdsPos, protPos, aminos, codons, existingVar, distance,
-         strand, sift, polyPhen, motifName, motifPos,
-         highInfPos, motifScoreChange) = annStr.split('|')
-        terms = effects.split("&")
+        # The field layout is given by the CSQ header description; see
+        # _getCsqFieldGetter.
+        (alt, featureId, effects, cdnaPos,
+         protPos) = self._csqFieldGetter(annStr.split(b'|'))
+        terms = effects.split(b'&')
         transcriptEffects = []
         for term in terms:
             transcriptEffects.append(
@@ -1217,11 +1442,8 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         :return: effect protocol.TranscriptEffect
         """
         effect = self._createGaTranscriptEffect()
-        (alt, effects, impact, symbol, geneName, featureType,
-         featureId, trBiotype, exon, intron, hgvsC, hgvsP,
-         cdnaPos, cdsPos, protPos, aminos, codons,
-         existingVar, distance, strand, symbolSource,
-         hgncId, hgvsOffset) = annStr.split('|')
+        (alt, effects, featureId, hgvsC, hgvsP, cdnaPos,
+         protPos) = _vepFieldGetter(annStr.split(b'|'))
         effect.alternateBases = alt
         effect.effects = self.convertSeqOntology(effects)
         effect.featureId = featureId
@@ -1243,10 +1465,8 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         :return: effect protocol.TranscriptEffect()
         """
         effect = self._createGaTranscriptEffect()
-        # SnpEff and VEP don't agree on this :)
-        (alt, effects, impact, geneName, geneId, featureType,
-            featureId, trBiotype, rank, hgvsC, hgvsP, cdnaPos,
-            cdsPos, protPos, distance, errsWarns) = annStr.split('|')
+        (alt, effects, featureId, hgvsC, hgvsP, cdnaPos,
+         protPos) = _snpEffFieldGetter(annStr.split(b'|'))
         effect.alternateBases = alt
         effect.effects = self.convertSeqOntology(effects)
         effect.featureId = featureId
@@ -1267,12 +1487,19 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         :param seqOntStr:
         :return: [protocol.OntologyTerm]
         """
-        seqOntTerms = seqOntStr.split('&')
+        seqOntTerms = seqOntStr.split(b'&')
         soTerms = []
+        # Only a handful of distinct terms occur in a VCF, so we keep the
+        # IDs we have looked up.
+        termIds = self._sequenceOntologyTermIds
         for soName in seqOntTerms:
             so = self._createGaOntologyTermSo()
             so.term = soName
-            so.id = self._sequenceOntologyTermMap.getId(soName, "")
+            soId = termIds.get(soName)
+            if soId is None:
+                soId = self._sequenceOntologyTermMap.getId(soName, "")
+                termIds[soName] = soId
+            so.id = soId
             soTerms.append(so)
         return soTerms
 
@@ -1309,12 +1536,18 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
             self, annotations, variant, hgvsG, transcriptConverter):
         transcriptEffects = []
         if annotations is not None:
-            for index, ann in enumerate(annotations):
-                altshgvsG = ""
-                if hgvsG is not None:
-                    # The HGVS.g field contains an element for
-                    # each alternate allele
-                    altshgvsG = hgvsG[index % len(variant.alternateBases)]
+            # The HGVS.g field contains an element for
+            # each alternate allele
+            altsHgvsG = []
+            if hgvsG is not None:
+                altsHgvsG = hgvsG[:len(variant.alternateBases)]
+            if altsHgvsG:
+                hgvsGs = itertools.cycle(altsHgvsG)
+            else:
+                # Without alternate alleles or HGVS.g values there is
+                # nothing to assign, but the effects are still converted.
+                hgvsGs = itertools.repeat("")
+            for ann, altshgvsG in itertools.izip(annotations, hgvsGs):
                 transcriptEffects.append(
                     transcriptConverter(ann, altshgvsG))
         return transcriptEffects
@@ -170,6 +170,32 @@ class TestCompoundIds(unittest.TestCase):
         self.assertEqual(compoundIdStr, obfuscated)
         self.assertEqual(compoundId.__class__, ExampleCompoundId)
 
+    def testGetIdString(self):
+        self.assertEqual(
+            ExampleCompoundId.getIdString(None, "a", "5", "c"),
+            str(ExampleCompoundId(None, "a", "5", "c")))
+        dataset = self.getDataset()
+        localIds = ["variant\"Set"]
+        self.assertEqual(
+            datamodel.VariantSetCompoundId.getIdString(
+                dataset.getCompoundId(), *localIds),
+            str(datamodel.VariantSetCompoundId(
+                dataset.getCompoundId(), *localIds)))
+        variantSet = self.getVariantSet()
+        localIds = ["chr\"1", "100", "md5"]
+        self.assertEqual(
+            datamodel.VariantCompoundId.getIdString(
+                variantSet.getCompoundId(), *localIds),
+            str(datamodel.VariantCompoundId(
+                variantSet.getCompoundId(), *localIds)))
+        self.assertRaises(
+            ValueError, datamodel.VariantCompoundId.getIdString,
+            variantSet.getCompoundId(), "chr1")
+        self.assertRaises(
+            exceptions.BadIdentifierNotStringException,
+            datamodel.VariantCompoundId.getIdString,
+            variantSet.getCompoundId(), "chr1", 100, "md5")
+
     def getDataset(self):
         return datasets.Dataset("dataset")
 
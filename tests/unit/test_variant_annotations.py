@@ -8,6 +8,8 @@ from __future__ import unicode_literals
 
 import unittest
 
+import pysam
+
 import ga4gh.protocol as protocol
 import ga4gh.datarepo as datarepo
 import ga4gh.datamodel.variants as variants
@@ -92,10 +94,21 @@ class TestHtslibVariantAnnotationSet(unittest.TestCase):
             effect, protPos, cdnaPos)
         self.assertEqual(testEffect, effect)
 
+    def testAddLocationsWithoutCdnaPosition(self):
+        effect = protocol.TranscriptEffect()
+        effect.hgvsAnnotation = protocol.HGVSAnnotation()
+        effect.hgvsAnnotation.transcript = "NM_001005484.1:c.431T>A"
+        self._variantAnnotationSet.addLocations(effect, "", "")
+        self.assertIsNone(effect.cDNALocation)
+        self.assertIsNone(effect.proteinLocation)
+        self.assertEqual(effect.CDSLocation.start, 430)
+        self.assertIsNone(effect.CDSLocation.alternateSequence)
+        self.assertIsNone(effect.CDSLocation.referenceSequence)
+
     def testHashVariantAnnotation(self):
         annotation = protocol.VariantAnnotation()
         variant = protocol.Variant()
-        expected = 'bec63dc7c876bb3c7b71422203b101d1'
+        expected = '0b000dbedeec6e500a9fa717e6aa37b3'
         hashed = self._variantAnnotationSet.hashVariantAnnotation(
             variant, annotation)
         self.assertEqual(hashed, expected)
@@ -103,6 +116,54 @@ class TestHtslibVariantAnnotationSet(unittest.TestCase):
     def testGetTranscriptEffectId(self):
         effect = protocol.TranscriptEffect()
         effect.effects = []
-        expected = '0e276f9254895cdeab4b0ec462b42117'
+        expected = 'd6a5ef3e0b8b41a9eac48d26729e88a2'
         hashed = self._variantAnnotationSet.getTranscriptEffectId(effect)
         self.assertEqual(hashed, expected)
+
+    def testGetAnnotationAnalysis(self):
+        vcfFile = ("tests/data/datasets/dataset1/variants/"
+                   "WASH7P_annotation/WASH7P_annotation.vcf.gz")
+        varFile = pysam.VariantFile(vcfFile)
+        other = variants.HtslibVariantAnnotationSet(
+            self._variantSet, "otherVAs")
+        analysis = self._variantAnnotationSet._getAnnotationAnalysis(varFile)
+        otherAnalysis = other._getAnnotationAnalysis(varFile)
+        self.assertEqual(analysis.info, otherAnalysis.info)
+        self.assertEqual(analysis.createDateTime, "2015-11-18T00:00:00Z")
+        self.assertNotEqual(analysis.id, otherAnalysis.id)
+        self.assertEqual(analysis.software, ["SnpEff"])
+
+    def testCsqFieldGetter(self):
+        fields = b"A|G|F|T|C|1/2|3/4|5/6".split(b"|")
+        getter = variants._getCsqFieldGetter(None, "test.vcf")
+        self.assertEqual(getter(fields + [b""] * 11), (
+            b"A", b"F", b"C", b"1/2", b"5/6"))
+        description = (
+            "Consequence annotations from Ensembl VEP. Format: "
+            "Consequence|Protein_position|Feature|Allele|cDNA_position")
+        getter = variants._getCsqFieldGetter(description, "test.vcf")
+        self.assertEqual(getter(fields[:5]), (
+            b"T", b"F", b"A", b"C", b"G"))
+        with self.assertRaises(ValueError) as context:
+            variants._getCsqFieldGetter("Format: Allele|Gene", "test.vcf")
+        self.assertIn("test.vcf", str(context.exception))
+        self.assertIn("Feature", str(context.exception))
+
+    def testConvertAnnotationsWithoutAlternateBases(self):
+        variant = protocol.Variant()
+        variant.alternateBases = []
+        annotations = [
+            b"A|upstream_gene_variant|MODIFIER|DDX11L1|DDX11L1|transcript|"
+            b"NR_046018.2|pseudogene||NR_046018.2:n.-1697_-1696insC|||||1696|",
+            b"A|intergenic_region|MODIFIER|DDX11L1|DDX11L1|"
+            b"intergenic_region|DDX11L1|||n.10177_10178insC||||||"]
+        converter = self._variantAnnotationSet.convertTranscriptEffectSnpEff
+        for hgvsG in [None, [], [b"1:g.10177A>T"]]:
+            effects = self._variantAnnotationSet._convertAnnotations(
+                annotations, variant, hgvsG, converter)
+            self.assertEqual(len(effects), len(annotations))
+            self.assertEqual(
+                [effect.featureId for effect in effects],
+                ["NR_046018.2", "DDX11L1"])
+            for effect in effects:
+                self.assertEqual(effect.hgvsAnnotation.genomic, "")